@@ -1,13 +1,24 @@
 import os
+import time
+import asyncio
+import orjson
+import logging
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.routing import APIRoute
+from fastapi.responses import HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from supabase import create_client, Client
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, constr
+import httpx
+from supabase import create_client, Client, ClientOptions
 from passlib.context import CryptContext
-from typing import Optional
+from typing import Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
 
 # =====================
 # 環境変数
@@ -18,23 +29,74 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("SUPABASE_URL / SUPABASE_KEY が未設定です")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# CORSを許可するオリジン（カンマ区切り）。ページと同じオリジンからしか使わないなら未設定でよい
+ALLOWED_ORIGINS = [o.strip() for o in os.environ.get("ALLOWED_ORIGINS", "").split(",") if o.strip()]
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    # ワーカーごとに1回だけ生成し、接続を使い回す
+    # HTTP/2 で1本のTLS接続に複数のリクエストを多重化する
+    http_client = httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(8.0, connect=3.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=8, keepalive_expiry=30),
+    )
+    return create_client(SUPABASE_URL, SUPABASE_KEY, ClientOptions(httpx_client=http_client))
 
 # =====================
 # FastAPI 設定
 # =====================
-app = FastAPI()
+class ORJSONRequest(Request):
+    # リクエストボディのJSONも orjson でデコードする
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def orjson_handler(request: Request) -> Response:
+            return await handler(ORJSONRequest(request.scope, request.receive))
+
+        return orjson_handler
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 応答済みの投稿が再起動で失われないよう、書き込みの完了を待ってから終了する
+    await asyncio.gather(*list(_pending_writes), return_exceptions=True)
+    # プールしている HTTP/2 接続を閉じる（一度も使われていなければ何もしない）
+    if get_supabase.cache_info().currsize:
+        get_supabase().options.httpx_client.close()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = ORJSONRoute
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 本番では制限推奨
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,  # プリフライト結果を1日キャッシュさせる
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# HTMLは静的ファイルなので起動時に読み込み、ブラウザにもキャッシュさせる
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+PAGE_HEADERS = {"Cache-Control": "public, max-age=3600"}
+
+def _read_page(name: str) -> bytes:
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        return f.read()
+
+_pages = {name: _read_page(name) for name in ("bbs.html", "login.html", "register.html")}
 
-templates = Jinja2Templates(directory="templates")
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 存在しないユーザーでも同じ時間がかかるよう、照合用のダミーハッシュを用意する
+_DUMMY_HASH = pwd_context.hash("dummy-password")
 
 # =====================
 # Models
@@ -48,7 +110,8 @@ class LoginData(BaseModel):
     password: str
 
 class PostData(BaseModel):
-    body: str
+    # 前後の空白を除き、空や長すぎる本文はI/O前に弾く
+    body: constr(strip_whitespace=True, min_length=1, max_length=2000)
     username: Optional[str] = None  # フロントには不要
     password: Optional[str] = None  # フロントには不要
 
@@ -56,16 +119,18 @@ class PostData(BaseModel):
 # ユーザー登録
 # =====================
 @app.post("/api/auth/register")
-async def register(data: RegisterData):
+async def register(data: RegisterData, sb: Client = Depends(get_supabase)):
     if len(data.username) < 3 or len(data.password) < 4:
         raise HTTPException(status_code=400, detail="入力が短すぎます")
 
-    hashed = pwd_context.hash(data.password)
+    # bcrypt はCPUを長時間使うのでイベントループの外で実行する
+    hashed = await run_in_threadpool(pwd_context.hash, data.password)
     try:
-        supabase.table("users").insert({
+        # Supabase への問い合わせもイベントループを塞がないようスレッドで実行する
+        await run_in_threadpool(lambda: sb.table("users").insert({
             "username": data.username,
             "password": hashed
-        }).execute()
+        }).execute())
         return {"success": True}
     except Exception:
         raise HTTPException(status_code=409, detail="ユーザー名は既に使われています")
@@ -74,72 +139,195 @@ async def register(data: RegisterData):
 # ログイン
 # =====================
 @app.post("/api/auth/login")
-async def login(data: LoginData):
-    res = supabase.table("users") \
-        .select("id, password") \
-        .eq("username", data.username) \
-        .limit(1) \
-        .execute()
-
-    if not res.data:
-        raise HTTPException(status_code=401, detail="ユーザーが存在しません")
+async def login(data: LoginData, sb: Client = Depends(get_supabase)):
+    res = await run_in_threadpool(lambda: sb.table("users")
+        .select("id, password")
+        .eq("username", data.username)
+        .limit(1)
+        .execute())
 
-    user = res.data[0]
-    if not pwd_context.verify(data.password, user["password"]):
-        raise HTTPException(status_code=401, detail="パスワードが違います")
+    user = res.data[0] if res.data else None
+    # ユーザーの有無に関わらず bcrypt 照合を行い、応答時間とメッセージを揃える
+    hashed = user["password"] if user else _DUMMY_HASH
+    ok = await run_in_threadpool(pwd_context.verify, data.password, hashed)
+    if not user or not ok:
+        raise HTTPException(status_code=401, detail="ユーザー名またはパスワードが違います")
 
     return {"success": True, "user_id": user["id"], "username": data.username}
 
 # =====================
 # 投稿取得
 # =====================
+POSTS_CACHE_TTL = 2.0  # 秒
+POSTS_PAGE_SIZE = 40
+POSTS_MAX_LIMIT = 100
+
+# 同時アクセスをまとめるための短時間キャッシュ（先頭ページのJSONバイト列を保持）
+_posts_cache = {"body": None, "etag": None, "ts": 0.0}
+# 実行中の取得処理。待っているリクエスト全員がこの結果を受け取る
+_posts_inflight: Optional[asyncio.Task] = None
+# 書き込みのたびに進める世代番号。取得中に書き込みがあった結果はキャッシュしない
+_posts_generation = 0
+
+def _posts_cache_fresh() -> bool:
+    return _posts_cache["body"] is not None and \
+        time.monotonic() - _posts_cache["ts"] < POSTS_CACHE_TTL
+
+def _invalidate_posts_cache():
+    global _posts_generation, _posts_inflight
+    _posts_generation += 1
+    _posts_cache["ts"] = 0.0
+    # 書き込み前に始まった取得には、これ以降のリクエストを相乗りさせない
+    _posts_inflight = None
+
+def _fetch_posts(
+    sb: Client,
+    before: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    limit: int = POSTS_PAGE_SIZE,
+) -> Tuple[bytes, str]:
+    # 同時刻の投稿を取りこぼさないよう id を第2キーにする。並び順に合わせた複合インデックスが必要:
+    #   CREATE INDEX CONCURRENTLY posts_created_at_id_desc ON posts (created_at DESC, id DESC);
+    q = sb.table("posts") \
+        .select("id, username, body, created_at") \
+        .order("created_at", desc=True) \
+        .order("id", desc=True) \
+        .limit(limit)
+    if before is not None:
+        ts = before.isoformat()
+        if before_id is not None:
+            q = q.or_(f'created_at.lt."{ts}",and(created_at.eq."{ts}",id.lt.{before_id})')
+        else:
+            q = q.lt("created_at", ts)
+    res = q.execute()
+    # 新しい順に並んでいるので先頭の投稿だけで変更を判定できる
+    newest = res.data[0] if res.data else None
+    etag = f'W/"{newest["id"]}-{newest["created_at"]}"' if newest else 'W/"empty"'
+    return orjson.dumps({"posts": res.data}), etag
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match はカンマ区切りの一覧や "*" も取り得る（比較は弱い比較）
+    if not if_none_match:
+        return False
+    tag = etag.removeprefix("W/")
+    return any(
+        t == "*" or t.removeprefix("W/") == tag
+        for t in (v.strip() for v in if_none_match.split(","))
+    )
+
+async def _refresh_posts(sb: Client) -> Tuple[bytes, str]:
+    global _posts_inflight
+    generation = _posts_generation
+    try:
+        body, etag = await run_in_threadpool(_fetch_posts, sb)
+        if generation == _posts_generation:
+            _posts_cache["body"] = body
+            _posts_cache["etag"] = etag
+            _posts_cache["ts"] = time.monotonic()
+        return body, etag
+    finally:
+        # 無効化後に始まった新しい取得は消さない
+        if _posts_inflight is asyncio.current_task():
+            _posts_inflight = None
+
 @app.get("/api/bbs/posts")
-async def get_posts():
+async def get_posts(
+    request: Request,
+    before: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    limit: int = POSTS_PAGE_SIZE,
+    sb: Client = Depends(get_supabase),
+):
+    global _posts_inflight
+    limit = min(max(limit, 1), POSTS_MAX_LIMIT)
+    if before_id is not None and before is None:
+        raise HTTPException(status_code=422, detail="before_id は before と一緒に指定してください")
+
     try:
-        res = supabase.table("posts") \
-            .select("id, username, body, created_at") \
-            .order("created_at", desc=True) \
-            .execute()
-        return {"posts": res.data}
+        if before is not None or limit != POSTS_PAGE_SIZE:
+            # 過去ページの読み込みはキャッシュせずそのまま取得する
+            body, etag = await run_in_threadpool(_fetch_posts, sb, before, before_id, limit)
+        elif _posts_cache_fresh():
+            body, etag = _posts_cache["body"], _posts_cache["etag"]
+        else:
+            # 取得中なら相乗りし、1回の問い合わせ結果を全員に返す
+            if _posts_inflight is None:
+                _posts_inflight = asyncio.create_task(_refresh_posts(sb))
+            # 1人が切断しても他の待機者の取得は止めない
+            body, etag = await asyncio.shield(_posts_inflight)
     except Exception:
         raise HTTPException(status_code=500, detail="投稿取得に失敗しました")
 
+    # 新しい投稿がなければ本文を返さない
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=1, must-revalidate"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # =====================
 # 投稿作成
 # =====================
-@app.post("/api/bbs/post")
-async def create_post(data: PostData, user_id: Optional[int] = None):
-    if not data.body.strip():
-        raise HTTPException(status_code=400, detail="本文が空です")
+# 実行中の書き込み。GCで途中破棄されないよう参照を持っておく
+_pending_writes: Set[asyncio.Task] = set()
+
+async def _insert_post(sb: Client, row: dict):
+    try:
+        await run_in_threadpool(lambda: sb.table("posts").insert(row).execute())
+        _invalidate_posts_cache()  # 次の取得で新しい投稿が見えるようにする
+    except Exception:
+        logger.exception("投稿の書き込みに失敗しました: %r", row)
 
+@app.post("/api/bbs/post")
+async def create_post(
+    data: PostData,
+    user_id: Optional[int] = None,
+    sb: Client = Depends(get_supabase),
+):
     # フロントはログインユーザーIDを送る
     if not user_id:
         raise HTTPException(status_code=401, detail="ログインしてください")
 
-    try:
-        now = datetime.now(timezone.utc).isoformat()
-        supabase.table("posts").insert({
-            "user_id": user_id,
-            "username": data.username,
-            "body": data.body.strip(),
-            "created_at": now
-        }).execute()
-        return {"success": True}
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail="投稿に失敗しました")
+    row = {
+        "user_id": user_id,
+        "username": data.username,
+        "body": data.body,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    # 書き込み完了を待たずに返す（フロントは投稿を即時表示する）
+    task = asyncio.create_task(_insert_post(sb, row))
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+    return {"success": True}
 
 # =====================
 # HTMLページ
 # =====================
 @app.get("/bbs", response_class=HTMLResponse)
-async def bbs_page(request: Request):
-    return templates.TemplateResponse("bbs.html", {"request": request})
+async def bbs_page():
+    return HTMLResponse(_pages["bbs.html"], headers=PAGE_HEADERS)
 
 @app.get("/login", response_class=HTMLResponse)
-async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+async def login_page():
+    return HTMLResponse(_pages["login.html"], headers=PAGE_HEADERS)
 
 @app.get("/register", response_class=HTMLResponse)
-async def register_page(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request})
+async def register_page():
+    return HTMLResponse(_pages["register.html"], headers=PAGE_HEADERS)
+
+# =====================
+# 起動
+# =====================
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        timeout_keep_alive=30,
+        limit_concurrency=1000,
+    )